@@ -9,16 +9,62 @@ Created on Mon Mar 10 16:47:29 2025
 """
 import argparse
 import os
-from typing import Optional, List
+from typing import Optional
 import torch
 import av
-from PIL import Image
+from torchvision.io import write_png
 from .taehv import TAEHV
 from .utils import load_torch_file
 from blissful_tuner.blissful_logger import BlissfulLogger
 
 logger = BlissfulLogger(__name__, "#8e00ed")
 
+# Linear latent -> RGB projection factors, per model family
+LATENT_RGB_PARAMS = {
+    "hunyuan": {
+        "rgb_factors": [
+            [-0.0395, -0.0331,  0.0445],
+            [ 0.0696,  0.0795,  0.0518],
+            [ 0.0135, -0.0945, -0.0282],
+            [ 0.0108, -0.0250, -0.0765],
+            [-0.0209,  0.0032,  0.0224],
+            [-0.0804, -0.0254, -0.0639],
+            [-0.0991,  0.0271, -0.0669],
+            [-0.0646, -0.0422, -0.0400],
+            [-0.0696, -0.0595, -0.0894],
+            [-0.0799, -0.0208, -0.0375],
+            [ 0.1166,  0.1627,  0.0962],
+            [ 0.1165,  0.0432,  0.0407],
+            [-0.2315, -0.1920, -0.1355],
+            [-0.0270,  0.0401, -0.0821],
+            [-0.0616, -0.0997, -0.0727],
+            [ 0.0249, -0.0469, -0.1703]
+        ],
+        "bias": [0.0259, -0.0192, -0.0761],
+    },
+    "wan": {
+        "rgb_factors": [
+            [-0.1299, -0.1692,  0.2932],
+            [ 0.0671,  0.0406,  0.0442],
+            [ 0.3568,  0.2548,  0.1747],
+            [ 0.0372,  0.2344,  0.1420],
+            [ 0.0313,  0.0189, -0.0328],
+            [ 0.0296, -0.0956, -0.0665],
+            [-0.3477, -0.4059, -0.2925],
+            [ 0.0166,  0.1902,  0.1975],
+            [-0.0412,  0.0267, -0.1364],
+            [-0.1293,  0.0740,  0.1636],
+            [ 0.0680,  0.3019,  0.1128],
+            [ 0.0032,  0.0581,  0.0639],
+            [-0.1251,  0.0927,  0.1699],
+            [ 0.0060, -0.0633,  0.0005],
+            [ 0.3477,  0.2275,  0.2950],
+            [ 0.1984,  0.0913,  0.1861]
+        ],
+        "bias": [-0.1835, -0.0868, -0.3360],
+    },
+}
+
 
 class LatentPreviewer():
     @torch.inference_mode()
@@ -40,7 +86,7 @@ class LatentPreviewer():
         self.dtype = dtype if dtype != torch.float8_e4m3fn else torch.float16
         if model_type != "framepack" and original_latents is not None and timesteps is not None:
             self.original_latents = original_latents.to(self.device)
-            self.timesteps_percent = timesteps / 1000
+            self.timesteps_percent = (timesteps / 1000).to(self.device)
         if self.model_type not in ["hunyuan", "wan", "framepack"]:
             raise ValueError(f"Unsupported model type: {self.model_type}")
 
@@ -54,10 +100,43 @@ class LatentPreviewer():
             self.decoder = self.decode_taehv
             self.scale_factor = None
             self.fps = args.fps
+            # Keep the cached noise in TAE's (B, F, C, H, W) layout so the per-step
+            # subtract already yields latents in decoder order and the dtype/device
+            # copy in decode_taehv is a contiguous one instead of a strided gather
+            if getattr(self, "original_latents", None) is not None:
+                if self.original_latents.ndim == 5:
+                    self.original_latents = self.original_latents.permute(0, 2, 1, 3, 4).contiguous()
+                else:  # wan latents arrive without a batch dim as (C, F, H, W)
+                    self.original_latents = self.original_latents.permute(1, 0, 2, 3).contiguous()
+            # CUDA Graph state for the decoder, captured lazily on first decode.
+            # framepack's history grows every section, so replay never pays there
+            self._tae_graph = None
+            self._tae_in = None
+            self._tae_out = None
+            self._tae_recaptures = 0
+            self._tae_graph_disabled = self.model_type == "framepack"
         elif self.mode == "latent2rgb":
             self.decoder = self.decode_latent2rgb
             self.scale_factor = 8
             self.fps = int(args.fps / 4)
+            # BF16 halves the memory traffic of the projection and the preview is
+            # quantized to uint8 anyway, so there is no visible quality cost
+            if torch.device(self.device).type == "cuda" and torch.cuda.is_bf16_supported():
+                self._preview_dtype = torch.bfloat16
+            else:
+                self._preview_dtype = self.dtype
+            # Build the projection tensors once so preview steps don't pay a host->device copy
+            params = LATENT_RGB_PARAMS["hunyuan" if self.model_type == "framepack" else self.model_type]
+            self._rgb_factors_T = torch.tensor(params["rgb_factors"], device=self.device, dtype=self._preview_dtype).transpose(0, 1)
+            self._rgb_bias = torch.tensor(params["bias"], device=self.device, dtype=self._preview_dtype)
+            if self.model_type == "framepack":
+                # framepack's history latents grow along the frame dim every section,
+                # which would force a recompile per preview under dynamic=False
+                self._pipeline = self._latent2rgb_pipeline
+            else:
+                # Preview shapes are constant across steps, so the subtract -> project ->
+                # upscale chain can be compiled once and its pointwise ops fused
+                self._pipeline = torch.compile(self._latent2rgb_pipeline, mode="reduce-overhead", dynamic=False)
 
     @torch.inference_mode()
     def preview(self, noisy_latents: torch.Tensor, current_step: Optional[int] = None) -> None:
@@ -67,60 +146,85 @@ class LatentPreviewer():
             noisy_latents = noisy_latents.unsqueeze(0)  # F, C, H, W -> B, F, C, H, W
         elif self.model_type in ["hunyuan", "framepack"]:
             pass  # already B, F, C, H, W
-        denoisy_latents = self.subtract_original_and_normalize(noisy_latents, current_step) if self.subtract_noise else noisy_latents
-        decoded = self.decoder(denoisy_latents)  # returned as F, C, H, W
-
-        # Upscale if we used latent2rgb so output is same size as expected
-        if self.scale_factor is not None:
-            upscaled = torch.nn.functional.interpolate(
-                decoded,
-                scale_factor=self.scale_factor,
-                mode="bicubic",
-                align_corners=False
-            )
+        if self.mode == "taehv":
+            noisy_latents = noisy_latents.permute(0, 2, 1, 3, 4)  # B, C, F, H, W -> B, F, C, H, W for TAE
+        if noisy_latents.device != self.device:
+            # wan's cpu-offload sampling and framepack's history buffer hand over CPU
+            # latents; decode on the previewer device rather than dragging the cached
+            # tensors (projection factors, original noise, timesteps) after the input.
+            # Copying here keeps the compiled pipeline's inputs on one device
+            noisy_latents = noisy_latents.to(self.device)
+        noise_remaining = self.timesteps_percent[current_step] if self.subtract_noise else None
+
+        if self.mode == "latent2rgb":
+            upscaled = self._pipeline(noisy_latents, noise_remaining)
         else:
-            upscaled = decoded
+            denoisy_latents = self.subtract_original_and_normalize(noisy_latents, noise_remaining) if self.subtract_noise else noisy_latents
+            upscaled = self.decoder(denoisy_latents)  # returned as F, C, H, W
 
         _, _, h, w = upscaled.shape
         self.write_preview(upscaled, w, h)
 
-    @torch.inference_mode()
-    def subtract_original_and_normalize(self, noisy_latents: torch.Tensor, current_step: int):
-        # Compute what percent of original noise is remaining
-        noise_remaining = self.timesteps_percent[current_step].to(device=noisy_latents.device)
-        # Subtract the portion of original latents
-        denoisy_latents = noisy_latents - (self.original_latents.to(device=noisy_latents.device) * noise_remaining)
-        # Normalize
-        normalized_denoisy_latents = (denoisy_latents - denoisy_latents.mean()) / (denoisy_latents.std() + 1e-8)
-        return normalized_denoisy_latents
+    def _latent2rgb_pipeline(self, noisy_latents: torch.Tensor, noise_remaining: Optional[torch.Tensor]) -> torch.Tensor:
+        """
+        The full latent2rgb chain: subtract/normalize, project to RGB and upscale.
+        Kept as one pure-tensor function so torch.compile can fuse the pointwise ops.
+        """
+        denoisy_latents = self.subtract_original_and_normalize(noisy_latents, noise_remaining) if noise_remaining is not None else noisy_latents
+        decoded = self.decode_latent2rgb(denoisy_latents)
+        # FP16 halves the bandwidth of the 8x bicubic upsample, whose output is 64x
+        # the input; the frames get quantized to uint8 right after so nothing is lost
+        if decoded.device.type == "cuda":
+            decoded = decoded.to(torch.float16)
+        # Channels-last makes the bicubic upsample cheaper and means the later
+        # (3, H, W) -> (H, W, 3) permute for AV is already the in-memory layout
+        decoded = decoded.contiguous(memory_format=torch.channels_last)
+        return torch.nn.functional.interpolate(
+            decoded,
+            scale_factor=self.scale_factor,
+            mode="bicubic",
+            align_corners=False
+        )
+
+    def subtract_original_and_normalize(self, noisy_latents: torch.Tensor, noise_remaining: torch.Tensor):
+        # Subtract the portion of original latents still present as noise. The scale
+        # stays a tensor so the compiled pipeline doesn't respecialize per step
+        denoisy_latents = noisy_latents - self.original_latents * noise_remaining
+        # Normalize in-place, computing both reductions in a single pass
+        std, mean = torch.std_mean(denoisy_latents)
+        return denoisy_latents.sub_(mean).div_(std.add_(1e-8))
 
     @torch.inference_mode()
-    def write_preview(self, frames: List[torch.Tensor], width: int, height: int) -> None:
+    def write_preview(self, frames: torch.Tensor, width: int, height: int) -> None:
         target = os.path.join(self.args.save_path, "latent_preview.mp4")
+        # Clamp to [0,1], scale and convert to byte
+        frames = frames.clamp_(0, 1).mul_(255).to(torch.uint8)
+
         # Check if we only have a single frame.
         if frames.shape[0] == 1:
-            # Clamp, scale, convert to byte and move to CPU
-            frame = frames[0].clamp(0, 1).mul(255).byte().cpu()
-            # Permute from (3, H, W) to (H, W, 3) for PIL.
-            frame_np = frame.permute(1, 2, 0).numpy()
-            # Change the target filename from .mp4 to .png
+            # Change the target filename from .mp4 to .png. libpng via torchvision is
+            # much faster than PIL here, and light compression suits a throwaway preview
             target_img = target.replace(".mp4", ".png")
-            Image.fromarray(frame_np).save(target_img)
+            write_png(frames[0].contiguous().cpu(), target_img, compression_level=3)
             return
 
+        # Permute to (F, H, W, 3) and move all frames to the CPU in a single transfer
+        # instead of one sync per frame
+        frames_np = frames.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
         # Otherwise, write out as a video.
         container = av.open(target, mode="w")
         stream = container.add_stream("libx264", rate=self.fps)
         stream.pix_fmt = "yuv420p"
         stream.width = width
         stream.height = height
+        # Previews are throwaway, so encode fast and on all cores to minimize the stall
+        stream.thread_count = os.cpu_count()
+        stream.thread_type = "FRAME"
+        stream.options = {"preset": "veryfast", "tune": "zerolatency", "crf": "23"}
 
         # Loop through each frame.
-        for frame in frames:
-            # Clamp to [0,1], scale, convert to byte and move to CPU.
-            frame = frame.clamp(0, 1).mul(255).byte().cpu()
-            # Permute from (3, H, W) -> (H, W, 3) for AV.
-            frame_np = frame.permute(1, 2, 0).numpy()
+        for frame_np in frames_np:
             video_frame = av.VideoFrame.from_ndarray(frame_np, format="rgb24")
             for packet in stream.encode(video_frame):
                 container.mux(packet)
@@ -134,94 +238,70 @@ class LatentPreviewer():
     def decode_taehv(self, latents: torch.Tensor):
         """
         Decodes latents with the TAEHV model, returns shape (F, C, H, W).
+        Expects latents already in TAE's (B, F, C, H, W) layout; preview() permutes
+        once up front so the subtract step hands them over in decoder order.
         """
-        self.taehv.to(self.device)  # Onload
-        latents_permuted = latents.permute(0, 2, 1, 3, 4)  # Reordered to B, F, C, H, W for TAE
-        latents_permuted = latents_permuted.to(device=self.device, dtype=self.dtype)
-        decoded = self.taehv.decode_video(latents_permuted, parallel=False, show_progress_bar=False)
-        self.taehv.to("cpu")  # Offload
+        latents = latents.to(device=self.device, dtype=self.dtype, non_blocking=True)
+        use_graph = torch.device(self.device).type == "cuda" and not self._tae_graph_disabled
+        if use_graph and self._tae_graph is not None and self._tae_in.shape != latents.shape:
+            # Allow one recapture (e.g. a genuine one-off shape change), but if shapes
+            # keep moving, recapturing per call costs more than replay ever saves
+            self._tae_recaptures += 1
+            if self._tae_recaptures > 1:
+                logger.info("TAEHV preview shape keeps changing, falling back to eager decode")
+                self._tae_graph_disabled = True
+                self._tae_graph = None
+                self._tae_in = None
+                self._tae_out = None
+                use_graph = False
+        if use_graph:
+            decoded = self._decode_taehv_graphed(latents)
+        else:
+            decoded = self.taehv.to(self.device).decode_video(latents, parallel=False, show_progress_bar=False)
         return decoded.squeeze(0)  # squeeze off batch dimension as next step doesn't want it
 
-    @torch.inference_mode()
+    def _decode_taehv_graphed(self, latents_permuted: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the TAEHV decoder through a captured CUDA Graph, replaying it on
+        subsequent calls. The decoder is small and launch-bound, so replaying one
+        graph instead of dispatching hundreds of kernels per step is a large win.
+        Recaptures if the latent shape changes.
+        """
+        if self._tae_graph is None or self._tae_in.shape != latents_permuted.shape:
+            # Graph replay requires stable weight addresses, so the (tiny) TAE has to
+            # stay resident on the GPU rather than being offloaded between previews
+            self.taehv.to(self.device)
+            self._tae_in = torch.empty_like(latents_permuted)
+            warmup_stream = torch.cuda.Stream()
+            warmup_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(warmup_stream):
+                for _ in range(2):
+                    self.taehv.decode_video(latents_permuted, parallel=False, show_progress_bar=False)
+            torch.cuda.current_stream().wait_stream(warmup_stream)
+            self._tae_graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._tae_graph):
+                self._tae_out = self.taehv.decode_video(self._tae_in, parallel=False, show_progress_bar=False)
+        self._tae_in.copy_(latents_permuted)
+        self._tae_graph.replay()
+        return self._tae_out
+
     def decode_latent2rgb(self, latents: torch.Tensor):
         """
         Decodes latents to RGB using linear transform, returns shape (F, 3, H, W).
         """
-        model_params = {
-            "hunyuan": {
-                "rgb_factors": [
-                    [-0.0395, -0.0331,  0.0445],
-                    [ 0.0696,  0.0795,  0.0518],
-                    [ 0.0135, -0.0945, -0.0282],
-                    [ 0.0108, -0.0250, -0.0765],
-                    [-0.0209,  0.0032,  0.0224],
-                    [-0.0804, -0.0254, -0.0639],
-                    [-0.0991,  0.0271, -0.0669],
-                    [-0.0646, -0.0422, -0.0400],
-                    [-0.0696, -0.0595, -0.0894],
-                    [-0.0799, -0.0208, -0.0375],
-                    [ 0.1166,  0.1627,  0.0962],
-                    [ 0.1165,  0.0432,  0.0407],
-                    [-0.2315, -0.1920, -0.1355],
-                    [-0.0270,  0.0401, -0.0821],
-                    [-0.0616, -0.0997, -0.0727],
-                    [ 0.0249, -0.0469, -0.1703]
-                ],
-                "bias": [0.0259, -0.0192, -0.0761],
-            },
-            "wan": {
-                "rgb_factors": [
-                    [-0.1299, -0.1692,  0.2932],
-                    [ 0.0671,  0.0406,  0.0442],
-                    [ 0.3568,  0.2548,  0.1747],
-                    [ 0.0372,  0.2344,  0.1420],
-                    [ 0.0313,  0.0189, -0.0328],
-                    [ 0.0296, -0.0956, -0.0665],
-                    [-0.3477, -0.4059, -0.2925],
-                    [ 0.0166,  0.1902,  0.1975],
-                    [-0.0412,  0.0267, -0.1364],
-                    [-0.1293,  0.0740,  0.1636],
-                    [ 0.0680,  0.3019,  0.1128],
-                    [ 0.0032,  0.0581,  0.0639],
-                    [-0.1251,  0.0927,  0.1699],
-                    [ 0.0060, -0.0633,  0.0005],
-                    [ 0.3477,  0.2275,  0.2950],
-                    [ 0.1984,  0.0913,  0.1861]
-                ],
-                "bias": [-0.1835, -0.0868, -0.3360],
-            },
-        }
-
-        latent_rgb_factors = model_params[self.model_type]["rgb_factors"] if self.model_type != "framepack" else model_params["hunyuan"]
-        latent_rgb_factors_bias = model_params[self.model_type]["bias"]
-
-        # Prepare linear transform
-        latent_rgb_factors = torch.tensor(
-            latent_rgb_factors,
-            device=latents.device,
-            dtype=latents.dtype
-        ).transpose(0, 1)
-        latent_rgb_factors_bias = torch.tensor(
-            latent_rgb_factors_bias,
-            device=latents.device,
-            dtype=latents.dtype
-        )
+        # Apply the linear transform to all frames at once: move channels last so the
+        # projection is a single batched matmul instead of one kernel per frame
+        extracted = latents.permute(0, 2, 3, 4, 1).to(self._preview_dtype).contiguous()  # (B, C, F, H, W) -> (B, F, H, W, C)
+        latent_images = torch.nn.functional.linear(extracted, self._rgb_factors_T, bias=self._rgb_bias)  # (B, F, H, W, 3)
+        latent_images = latent_images.squeeze(0)  # squeeze off batch dimension -> (F, H, W, 3)
 
-        # For each frame, apply the linear transform
-        latent_images = []
-        for t in range(latents.shape[2]):
-            extracted = latents[:, :, t, :, :][0].permute(1, 2, 0)  # shape = (H, W, C) after .permute(1,2,0)
-            rgb = torch.nn.functional.linear(extracted, latent_rgb_factors, bias=latent_rgb_factors_bias)  # shape = (H, W, 3) after linear
-            latent_images.append(rgb)
-
-        # Stack frames into (F, H, W, 3)
-        latent_images = torch.stack(latent_images, dim=0)
-
-        # Normalize to [0..1]
-        latent_images_min = latent_images.min()
-        latent_images_max = latent_images.max()
-        if latent_images_max > latent_images_min:
-            latent_images = (latent_images - latent_images_min) / (latent_images_max - latent_images_min)
+        # Normalize to [0..1], upcasting so the reductions run at full precision.
+        # aminmax gets both extrema in one sweep and clamping the range keeps the
+        # divide safe without a data-dependent branch
+        latent_images = latent_images.to(torch.float32)
+        latent_images_min, latent_images_max = torch.aminmax(latent_images)
+        latent_images_range = (latent_images_max - latent_images_min).clamp_min_(1e-8)
+        latent_images = latent_images.sub_(latent_images_min).div_(latent_images_range)
 
         # Permute to (F, 3, H, W) before returning
         latent_images = latent_images.permute(0, 3, 1, 2)
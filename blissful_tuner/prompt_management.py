@@ -6,97 +6,155 @@ Extensions for prompt related stuff for Blissful Tuner
 License: Apache 2.0
 @author: blyss
 """
+import functools
+import itertools
 import os
 import random
 from transformers import T5Model
 import torch
 import re
-from typing import Tuple, List, Union
+from typing import Dict, Tuple, List, Union
 from blissful_tuner.blissful_logger import BlissfulLogger
 logger = BlissfulLogger(__name__, "#8e00ed")
 
+WILDCARD_PATTERN = re.compile(r"__([^_]+?)__")
+WEIGHT_PATTERN = re.compile(r"\((.*?):([\d\.]+)\)")
+
 
 def rescale_text_encoders_hunyuan(llm_scale: float, clip_scale: float, transformer: torch.nn.Module) -> torch.nn.Module:
     logger.info(f"Scaling relative TE influence to LLM:{llm_scale}; CLIP:{clip_scale}")
     clip_multiplier = float(clip_scale)
     llm_multiplier = float(llm_scale)
+
+    def scale_output(module, _inputs, output):
+        return output.mul_(module._te_scale)
+
     # Scale CLIP influence
     if hasattr(transformer, "txt_in"):
         txt_in = transformer.txt_in
         if hasattr(txt_in, "c_embedder"):
-            original_c_embedder_forward = txt_in.c_embedder.forward
-
-            def scaled_c_embedder_forward(*args, **kwargs):
-                output = original_c_embedder_forward(*args, **kwargs)
-                return output * clip_multiplier
-            txt_in.c_embedder.forward = scaled_c_embedder_forward
+            # Forward hooks are dispatched inside PyTorch rather than through a Python
+            # closure, and mul_ scales the output buffer without an extra allocation.
+            # Buffers are non-persistent so they stay out of any saved state dict.
+            txt_in.c_embedder.register_buffer("_te_scale", torch.tensor(clip_multiplier), persistent=False)
+            txt_in.c_embedder.register_forward_hook(scale_output)
             # Scale LLM influence
             if hasattr(txt_in, "individual_token_refiner"):
-                for i, block in enumerate(txt_in.individual_token_refiner.blocks):
-                    original_block_forward = block.forward
-
-                    def scaled_block_forward(*args, **kwargs):
-                        output = original_block_forward(*args, **kwargs)
-                        return output * llm_multiplier
-                    block.forward = scaled_block_forward
+                for block in txt_in.individual_token_refiner.blocks:
+                    block.register_buffer("_te_scale", torch.tensor(llm_multiplier), persistent=False)
+                    block.register_forward_hook(scale_output)
     return transformer
 
 
-def wildcard_replace(wildcard: str, wildcard_location: str) -> str:
+class WildcardStore():
     """
-    Replace a single __wildcard__ by picking a weighted random entry
-    from the file `{wildcard}.txt` in `wildcard_location`.
+    Loads and caches wildcard files from a base directory.
+
+    Each `{name}.txt` is read and parsed at most once; after that a pick is two
+    dict lookups plus a weighted choice over precomputed cumulative weights.
 
     Supports subdirectories (e.g. "colors/Autumn") but forbids:
       - Absolute paths (leading '/')
       - Parent traversal ('..')
     """
-    # 1) Sanitize the wildcard key
-    if os.path.isabs(wildcard):
-        raise ValueError(f"Absolute paths not allowed in wildcard: {wildcard!r}")
-    if ".." in wildcard.split(os.sep):
-        raise ValueError(f"Parent-directory traversal not allowed in wildcard: {wildcard!r}")
-
-    # 2) Build and resolve the real path
-    base_dir = os.path.abspath(wildcard_location)
-    candidate = os.path.abspath(os.path.join(base_dir, f"{wildcard}.txt"))
-
-    # 3) Ensure it's still inside base_dir
-    if not (candidate == base_dir or candidate.startswith(base_dir + os.sep)):
-        raise ValueError(f"Wildcard path escapes base directory: {candidate}")
-
-    # 4) Load options & weights
-    options: List[str] = []
-    weights: List[float] = []
-    if not os.path.isfile(candidate):
-        raise FileNotFoundError(f"Wildcard file not found: {candidate}")
-
-    with open(candidate, "r", encoding="utf-8") as f:
-        for raw in f:
-            line = raw.strip()
-            if not line or line.startswith("#"):
-                continue
-
-            if ":" in line:
-                name, w_str = line.split(":", 1)
-                name = name.strip()
-                try:
-                    weight = float(w_str.strip())
-                except ValueError:
-                    raise ValueError(f"Invalid weight '{w_str}' in {candidate!r} on line: {raw!r}")
-            else:
-                name = line
-                weight = 1.0
-
-            if name:
-                options.append(name)
-                weights.append(weight)
-
-    if not options:
-        raise ValueError(f"No valid options found in wildcard file: {candidate}")
-
-    # 5) Pick one by relative weights
-    return random.choices(options, weights=weights, k=1)[0]
+
+    def __init__(self, base_dir: str):
+        self._base_dir = os.path.abspath(os.fspath(base_dir))
+        self._cache: Dict[str, Tuple[Tuple[str, ...], Tuple[float, ...]]] = {}
+
+    def get(self, wildcard: str) -> str:
+        """Pick a weighted random entry for a single __wildcard__ key."""
+        entry = self._cache.get(wildcard)
+        if entry is None:
+            entry = self._cache[wildcard] = self._load(wildcard)
+        options, cum_weights = entry
+        return random.choices(options, cum_weights=cum_weights, k=1)[0]
+
+    def preload(self) -> None:
+        """Parse every wildcard file under base_dir up front so later picks never touch the disk."""
+        if not os.path.isdir(self._base_dir):
+            return
+        pending = [self._base_dir]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif entry.name.endswith(".txt"):
+                        key = os.path.relpath(entry.path, self._base_dir)[:-len(".txt")]
+                        try:
+                            self._cache[key] = self._parse_file(entry.path)
+                        except ValueError as e:
+                            # The directory may hold .txt files that aren't wildcards;
+                            # skip them here and stay strict in _load so explicitly
+                            # referenced wildcards still error loudly
+                            logger.warning(f"Skipping unparseable wildcard file {entry.path}: {e}")
+
+    def _load(self, wildcard: str) -> Tuple[Tuple[str, ...], Tuple[float, ...]]:
+        # 1) Sanitize the wildcard key
+        if os.path.isabs(wildcard):
+            raise ValueError(f"Absolute paths not allowed in wildcard: {wildcard!r}")
+        if ".." in wildcard.split(os.sep):
+            raise ValueError(f"Parent-directory traversal not allowed in wildcard: {wildcard!r}")
+
+        # 2) Build and resolve the real path, ensuring it's still inside base_dir
+        candidate = os.path.normpath(os.path.join(self._base_dir, f"{wildcard}.txt"))
+        if not candidate.startswith(self._base_dir + os.sep):
+            raise ValueError(f"Wildcard path escapes base directory: {candidate}")
+
+        if not os.path.isfile(candidate):
+            raise FileNotFoundError(f"Wildcard file not found: {candidate}")
+        return self._parse_file(candidate)
+
+    @staticmethod
+    def _parse_file(candidate: str) -> Tuple[Tuple[str, ...], Tuple[float, ...]]:
+        options: List[str] = []
+        weights: List[float] = []
+        with open(candidate, "r", encoding="utf-8") as f:
+            for raw in f:
+                line = raw.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                name, sep, w_str = line.partition(":")
+                if sep:
+                    name = name.strip()
+                    try:
+                        weight = float(w_str.strip())
+                    except ValueError:
+                        raise ValueError(f"Invalid weight '{w_str}' in {candidate!r} on line: {raw!r}")
+                else:
+                    weight = 1.0
+
+                if name:
+                    options.append(name)
+                    weights.append(weight)
+
+        if not options:
+            raise ValueError(f"No valid options found in wildcard file: {candidate}")
+
+        # Precompute cumulative weights so random.choices skips rebuilding them per pick
+        return tuple(options), tuple(itertools.accumulate(weights))
+
+
+@functools.lru_cache(maxsize=None)
+def get_wildcard_store(base_dir: str) -> WildcardStore:
+    """
+    Return the preloaded WildcardStore for a base directory, building and
+    scanning it only on the first request so callers that process one prompt
+    at a time don't re-walk the wildcard tree per call.
+    """
+    store = WildcardStore(base_dir)
+    store.preload()
+    return store
+
+
+def wildcard_replace(wildcard: str, wildcard_location: str) -> str:
+    """
+    Replace a single __wildcard__ by picking a weighted random entry
+    from the file `{wildcard}.txt` in `wildcard_location`.
+    """
+    return WildcardStore(wildcard_location).get(wildcard)
 
 
 def process_wildcards(
@@ -118,21 +176,24 @@ def process_wildcards(
     single = isinstance(prompts, str)
     prompt_list = [prompts] if single else list(prompts)
 
-    pattern = re.compile(r"__([^_]+?)__")
+    store = get_wildcard_store(os.path.abspath(wildcard_location))
 
     def replace_in_one(prompt: str) -> str:
         replacements = []
+
+        def repl(match: "re.Match") -> str:
+            key = match.group(1)
+            replacement = store.get(key)
+            replacements.append(f"{key} -> {replacement}")
+            return replacement
+
         depth = 0
         while depth < max_depth:
-            # find all wildcard markers in this prompt
-            matches = pattern.findall(prompt)
-            if not matches:
+            # replace every wildcard marker in a single pass over the prompt
+            new_prompt = WILDCARD_PATTERN.sub(repl, prompt)
+            if new_prompt == prompt:
                 break
-            # for each unique key, get replacement and do a global sub
-            for key in set(matches):
-                replacement = wildcard_replace(key, wildcard_location)
-                prompt = re.sub(f"__{re.escape(key)}__", replacement, prompt)
-                replacements.append(f"{key} -> {replacement}")
+            prompt = new_prompt
             depth += 1
 
         if depth >= max_depth:
@@ -142,7 +203,8 @@ def process_wildcards(
             logger.info(f"Wildcard replacements: {replacement_string}")
         return prompt
 
-    # Process each prompt
+    # Process each prompt sequentially; with the store preloaded there is no IO
+    # left to overlap, and a fixed order keeps seeded wildcard picks reproducible
     processed = [replace_in_one(p) for p in prompt_list]
 
     # Return same type as input
@@ -182,29 +244,27 @@ class MiniT5Wrapper():
             all_weights.append(weights)
         context = self.t5(prompts, device)
 
-        # Apply weights to embeddings if any were extracted
+        # Apply weights to embeddings if any were extracted, folding them into a
+        # single scalar so each embedding is scaled with one in-place multiply
         for i, weights in enumerate(all_weights):
+            scale = 1.0
             for text, weight in weights.items():
                 logger.info(f"Applying weight ({weight}) to promptchunk: '{text}'")
-                if len(weights) > 0:
-                    context[i] = context[i] * weight
+                scale *= weight
+            if scale != 1.0:
+                context[i].mul_(scale)
         self.times_called += 1
         return context
 
     def parse_prompt_weights(self, prompt: str) -> Tuple[str, dict]:
         """Extract text and weights from prompts with (text:weight) format"""
-        # Parse all instances of (text:weight) in the prompt
-        pattern = r'\((.*?):([\d\.]+)\)'
-        matches = re.findall(pattern, prompt)
-
-        # Replace each match with just the text part
-        cleaned_prompt = prompt
         weights = {}
 
-        for match in matches:
-            text, weight = match
-            orig_text = f"({text}:{weight})"
-            cleaned_prompt = cleaned_prompt.replace(orig_text, text)
+        # Replace each (text:weight) with just the text part in a single pass
+        def repl(match: "re.Match") -> str:
+            text, weight = match.group(1), match.group(2)
             weights[text] = float(weight)
+            return text
 
+        cleaned_prompt = WEIGHT_PATTERN.sub(repl, prompt)
         return cleaned_prompt, weights